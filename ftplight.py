@@ -11,13 +11,46 @@ for repeat()? Well, why not keep it simple.
 Created: 06.09.20
 """
 
-from ftplib import FTP
+from ftplib import FTP, all_errors, error_perm
 import logging
-from typing import Union, Tuple, Any, List
+import random
+import socket
+import threading
+import time
+from io import BytesIO
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from typing import Union, Tuple, Any, List, Iterator
 from pathlib import Path
 
 import johanna
 
+# write buffer for downloads to disk
+WRITE_BUFFER = 1 << 20
+
+# max. bytes per recv() and callback in retrbinary, ftplib's default is 8 KiB
+BLOCK_SIZE = 1 << 20
+
+# upper limit for the exponential backoff in repeat()
+MAX_THROTTLE_SEC = 30.0
+
+
+# johanna.collect_stat() does a plain +=, downloads run on several threads
+_STAT_LOCK = threading.Lock()
+
+
+def collect_download_stat(volume: int, sec: float) -> None:
+    """
+    Add one finished transfer to johanna's statistics, thread safe.
+    :param volume: bytes transferred
+    :param sec: duration of the transfer
+    """
+    with _STAT_LOCK:
+        johanna.collect_stat("ftp_download_bytes_cnt", volume)
+        johanna.collect_stat("ftp_download_time_sec", sec)
+        johanna.collect_stat("ftp_download_file_cnt", 1)
+
 
 def get_station_match(station: int = None) -> str:
     return f"*_{station:05d}_*.zip" if station else "*.zip"
@@ -29,6 +62,10 @@ def dwd(folder):
     with johanna.Timer() as t:
         ftp = FTP(SERVER, timeout=15)
         ftp.login()  # anonymous
+        # lots of short request/response pairs (TYPE, PASV, RETR) on the control channel
+        ftp.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # the control channel is idle during long transfers, don't let a NAT forget it
+        ftp.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
         ftp.cwd(folder)
     logging.info(f"Connected to ftp://{SERVER}/{folder} {t.read()}")
     return ftp
@@ -37,10 +74,12 @@ def dwd(folder):
 def repeat(callback, do_times: int = 3, throttle_sec: float = 3.0) -> Union[Tuple[bool, None], Tuple[bool, Any]]:
     """
     Repeat callback n times, with throttling to tame external resource access.
+    The wait doubles with every failed attempt (plus some jitter), so that quick
+    hiccups are retried soon while a struggling server gets more air.
     Utilizes https://stackoverflow.com/questions/2083987/how-to-retry-after-exception/7663441#7663441
     :param callback: Function w/o parameters, may raise Exceptions or TimeoutError.
     :param do_times: Try at most that often to execute callback().
-    :param throttle_sec: Wait a short time before executing callback().
+    :param throttle_sec: Wait before the first retry, doubled for each further one.
     :return: (True, result of callback) if operation was successful, else (False, None)
     """
     assert isinstance(do_times, int)
@@ -59,8 +98,10 @@ def repeat(callback, do_times: int = 3, throttle_sec: float = 3.0) -> Union[Tupl
             logging.exception("Exception!")
         else:  # executed when the execution falls thru the try
             break
-        logging.info(f"Retrying after {throttle_sec:0.1f} sec ...")
-        johanna.sleep(throttle_sec)
+        if attempt + 1 < do_times:  # no need to wait after the last attempt
+            wait_sec = min(throttle_sec * 2 ** attempt, MAX_THROTTLE_SEC) + random.uniform(0.0, 1.0)
+            logging.info(f"Retrying after {wait_sec:0.1f} sec ...")
+            johanna.sleep(wait_sec)
     else:
         johanna.flag_as_error()
         logging.error(f"Finally failed.")
@@ -77,19 +118,15 @@ def ftp_nlst(ftp: FTP, station: int = None) -> list:
     :return: List of file names (maybe empty) or None in case of issues.
     """
 
-    def collect(fnam: str) -> None:  # Callback for FTP.retrlines
-        collect.zips.append(fnam)
-        johanna.collect_stat("ftp_download_bytes_cnt", len(fnam))
-
     def download() -> list:
-        collect.zips = list()
+        zips = list()
         with johanna.Timer() as t:
-            rt = ftp.retrlines(f"NLST {station_match}", callback=collect)
+            # plain append as callback, statistics are collected once afterwards
+            rt = ftp.retrlines(f"NLST {station_match}", callback=zips.append)
         logging.info(rt)  # like "226 Directory send OK."
-        logging.info(f"Retrieved {len(collect.zips)} filenames {t.read()}")
-        johanna.collect_stat("ftp_download_time_sec", t.read(raw=True))
-        johanna.collect_stat("ftp_download_file_cnt", 1)
-        return collect.zips
+        logging.info(f"Retrieved {len(zips)} filenames {t.read()}")
+        collect_download_stat(sum(len(fnam) for fnam in zips), t.read(raw=True))
+        return zips
 
     station_match = get_station_match(station)
     logging.info(f"FTP: trying ot NLST {station_match}")
@@ -100,47 +137,162 @@ def ftp_nlst(ftp: FTP, station: int = None) -> list:
     return fnams
 
 
-def ftp_retrbinary(ftp: FTP, from_fnam: str, to_path: Path, verbose: bool = False) -> Path:
+def ftp_mdtm(ftp: FTP, fnam: str) -> str:
     """
-    Download file to local.
+    Ask the server for the modification time of a file.
     :param ftp: Mandatory open FTP connection in proper subdirectory.
-    :param from_fnam: Mandatory file name for download.
-    :param to_path: Mandatory local Path to download file to.
-    :param verbose: Print tick per 100 packages.
-    :return: Path of downloaded file or None on failure.
+    :param fnam: Mandatory file name.
+    :return: UTC time as YYYYMMDDHHMMSS or None if the server will not tell.
     """
+    try:
+        return ftp.sendcmd("MDTM " + fnam).split()[1][:14]  # like "213 20201014093512"
+    except all_errors + (IndexError,):  # nice to know only
+        return None
 
-    def collect(b: bytes) -> None:  # Callback für FTP.retrbinary
+
+def _retrbinary(ftp: FTP, from_fnam: str, to_path: Path = None, verbose: bool = False) -> Union[Path, bytes]:
+    """
+    One attempt to download a file, see ftp_retrbinary().
+    :return: Path of downloaded file or bytes, raises on failure.
+    """
+
+    def collect(b: bytes) -> None:  # Callback für FTP.retrbinary, nur für verbose
         collect.open_file.write(b)
         collect.cnt += 1
-        collect.volume += len(b)
-        tick = (collect.cnt % 100 == 0)
-        if verbose and tick:
+        if collect.cnt % 100 == 0:
             print(".", end="", flush=True)
 
-    def download() -> Path:
-        collect.cnt = 0
-        collect.volume = 0
-        with johanna.Timer() as t:
-            with open(to_path, 'wb') as collect.open_file:
-                rt = ftp.retrbinary("RETR " + from_fnam, collect)
-            if verbose:
-                print()  # awkward
-        logging.info(rt)
-        logging.info(f"Downloaded {collect.volume:,} bytes in {collect.cnt} blocks {t.read()}")
-        johanna.collect_stat("ftp_download_bytes_cnt", collect.volume)
-        johanna.collect_stat("ftp_download_time_sec", t.read(raw=True))
-        johanna.collect_stat("ftp_download_file_cnt", 1)
-        return to_path
+    collect.cnt = 0
+    with johanna.Timer() as t:
+        if to_path:
+            with open(to_path, 'wb', buffering=WRITE_BUFFER) as collect.open_file:
+                # w/o ticks the (C-implemented) write() is the callback, no Python frame per block
+                rt = ftp.retrbinary("RETR " + from_fnam, collect if verbose else collect.open_file.write,
+                                    blocksize=BLOCK_SIZE)
+                volume = collect.open_file.tell()
+        else:
+            collect.open_file = BytesIO()
+            rt = ftp.retrbinary("RETR " + from_fnam, collect if verbose else collect.open_file.write,
+                                blocksize=BLOCK_SIZE)
+            volume = collect.open_file.tell()
+        if verbose:
+            print()  # awkward
+    logging.info(rt)
+    logging.info(f"Downloaded {volume:,} bytes {t.read()}")
+    collect_download_stat(volume, t.read(raw=True))
+    return to_path if to_path else collect.open_file.getvalue()
+
 
+def ftp_retrbinary(ftp: FTP, from_fnam: str, to_path: Path = None, verbose: bool = False) -> Union[Path, bytes]:
+    """
+    Download file to local.
+    :param ftp: Mandatory open FTP connection in proper subdirectory.
+    :param from_fnam: Mandatory file name for download.
+    :param to_path: Path to download file to. If None the file content will be returned as bytes.
+    :param verbose: Print tick per 100 blocks.
+    :return: Path of downloaded file or bytes – or None on failure.
+    """
     logging.info(f"FTP: trying to RETR {from_fnam} in BINARY mode ...")
-    success, path = repeat(download, do_times=3, throttle_sec=3.0)
+    success, path = repeat(lambda: _retrbinary(ftp, from_fnam, to_path, verbose), do_times=3, throttle_sec=3.0)
     if not success:
         logging.info(f"Cannot retrieve file {from_fnam}.")
-        # None will be returned, not target path
+        # None will be returned, not target path or file content
     return path
 
 
+class RateLimit:
+    """
+    Spaces out events to at most per_sec per second, shared by all threads.
+    Unlike a fixed sleep after each file, slow transfers do not add idle time.
+    """
+
+    def __init__(self, per_sec: float):
+        assert per_sec > 0
+        self._interval = 1.0 / per_sec
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        """
+        Block until the next event is allowed.
+        """
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self._interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def parallel_download(folder: str, fnams: List[str], to_dir: Path = None, workers: int = 4,
+                      max_per_sec: float = None) -> Iterator[Tuple[str, Union[Path, bytes]]]:
+    """
+    Download many files concurrently, each worker thread on a FTP connection of its own.
+    Per-file latency (PASV, RETR, 226) dominates for the many small DWD files, and the
+    GIL is released while waiting for the sockets, so threads are good enough here.
+    :param folder: Mandatory folder on the DWD server, see dwd().
+    :param fnams: Mandatory list of file names for download.
+    :param to_dir: Local directory to download files to. If None file contents will be returned as bytes.
+    :param workers: Number of parallel FTP connections. Be nice to the DWD.
+    :param max_per_sec: Start at most this many downloads per second. None for no limit.
+    :return: Yields (file name, Path or bytes – or None on failure) in the order of fnams.
+    """
+    assert isinstance(workers, int)
+    assert 0 < workers <= 8
+
+    def download(fnam: str) -> Tuple[str, Union[Path, bytes]]:
+        ftp = pool.get()  # there is exactly one slot per worker, None if not (yet) connected
+
+        def attempt() -> Union[Path, bytes]:
+            nonlocal ftp
+            if ftp is None:
+                ftp = dwd(folder)
+            try:
+                return _retrbinary(ftp, fnam, to_dir / fnam if to_dir else None)
+            except error_perm:  # like 550, the server answered, so the connection is fine
+                raise
+            except all_errors:
+                # maybe a dead connection: the next attempt starts over with a fresh one
+                ftp.close()
+                ftp = None
+                raise
+
+        try:
+            if limit:
+                limit.wait()
+            logging.info(f"FTP: trying to RETR {fnam} in BINARY mode ...")
+            success, result = repeat(attempt, do_times=3, throttle_sec=3.0)
+            if not success:
+                logging.info(f"Cannot retrieve file {fnam}.")
+            return fnam, result
+        finally:
+            pool.put(ftp)
+
+    workers = min(workers, len(fnams))
+    if not workers:
+        return
+    limit = RateLimit(max_per_sec) if max_per_sec else None
+    pool = Queue()
+    try:
+        for _ in range(workers):
+            pool.put(None)  # connect lazily in attempt(), a failed login is retried there
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # only few downloads in advance, so that contents in memory will not pile up;
+            # results are yielded in the order of fnams, the caller may depend on it
+            pending = deque()
+            for fnam in fnams:
+                pending.append(executor.submit(download, fnam))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    finally:
+        while not pool.empty():
+            ftp = pool.get()
+            if ftp:
+                ftp.close()
+
+
 def ftp_retrlines(ftp: FTP, from_fnam: str, to_path: Path = None, verbose: bool = False) -> Union[Path, List[str]]:
     """
     Download file to local.
@@ -153,7 +305,12 @@ def ftp_retrlines(ftp: FTP, from_fnam: str, to_path: Path = None, verbose: bool
 
     def collect(s: str) -> None:  # Callback für FTP.retrlines
         if to_path:
-            collect.open_file.write(s + "\n")
+            # no new str per line, written in chunks of WRITE_BUFFER bytes
+            collect.buf += s.encode(ftp.encoding)
+            collect.buf.append(0x0A)  # \n
+            if len(collect.buf) >= WRITE_BUFFER:
+                collect.open_file.write(collect.buf)
+                collect.buf.clear()
             collect.cnt += 1
             collect.volume += len(s) + 1
         else:
@@ -169,8 +326,10 @@ def ftp_retrlines(ftp: FTP, from_fnam: str, to_path: Path = None, verbose: bool
         collect.volume = 0
         with johanna.Timer() as t:
             if to_path:
-                with open(to_path, 'w') as collect.open_file:
+                collect.buf = bytearray()
+                with open(to_path, 'wb') as collect.open_file:
                     rt = ftp.retrlines("RETR " + from_fnam, collect)
+                    collect.open_file.write(collect.buf)
             else:
                 collect.lines = []
                 rt = ftp.retrlines("RETR " + from_fnam, collect)
@@ -178,9 +337,7 @@ def ftp_retrlines(ftp: FTP, from_fnam: str, to_path: Path = None, verbose: bool
                 print()  # awkward
         logging.info(rt)
         logging.info(f"Downloaded {collect.volume:,} bytes in {collect.cnt} lines {t.read()}")
-        johanna.collect_stat("ftp_download_bytes_cnt", collect.volume)
-        johanna.collect_stat("ftp_download_time_sec", t.read(raw=True))
-        johanna.collect_stat("ftp_download_file_cnt", 1)
+        collect_download_stat(collect.volume, t.read(raw=True))
         return to_path if to_path else collect.lines
 
     logging.info(f"FTP: trying to RETR {from_fnam} in TEXT mode ...")
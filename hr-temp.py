@@ -5,14 +5,16 @@
 Download DWD Stundenwerte Lufttemperatur 2m.
 
 Usage:
-  hr-temp.py ( --recent | --historical | --stations | --test )
+  hr-temp.py ( --recent | --historical | --stations | --check | --test )
 
 Options:
   -h --help         Zeige die Bedeutung der Parameter
-  --recent          Download der letzten ca. 500 Tage
+  --recent          Download der letzten ca. 500 Tage (frischt vorher die
+                    Stationsliste auf)
   --historical      Download des historischen Datenbestandes (das setzt eine
                     leere Datenbank voraus, prüft es aber nicht)
   --stations        Download der Stationsliste
+  --check           Prüfen, ob die Tabelle recent zu den Messwerten passt
   --test            Experimentellen oder Einmal-Code ausführen
 """
 # Created: 09.08.20
@@ -23,14 +25,16 @@ Options:
 import json
 import os
 import logging
-from ftplib import FTP
+import time
 from pathlib import Path
-from tempfile import TemporaryDirectory
-from zipfile import ZipFile
+from zipfile import ZipFile, ZipInfo
+from io import BytesIO, TextIOWrapper
 import csv
 from dataclasses import dataclass
+from itertools import islice, chain
+from operator import itemgetter
 from datetime import date, timedelta
-from typing import List
+from typing import List, Dict, Tuple, BinaryIO, Iterable, Iterator
 
 from docopt import docopt
 
@@ -45,7 +49,89 @@ def iso_date(s: str) -> str:
     :return: Datum in Schreibweise YYYY-MM-DD
     """
     # 19690523 -> 1969-05-23
-    return "%s-%s-%s" % (s[0:4], s[4:6], s[6:])
+    return f"{s[0:4]}-{s[4:6]}-{s[6:]}"
+
+
+# https://www.sqlite.org/pragma.html -- journal_mode=WAL bleibt in der Datenbankdatei stehen,
+# die anderen gelten nur für die jeweilige Connection
+BULK_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",     # 64 MB
+    "PRAGMA mmap_size=268435456",   # 256 MB, Indexzugriffe für INSERT OR IGNORE ohne read()
+]
+
+
+def begin_bulk(c: johanna.Connection) -> None:
+    """
+    Bereitet eine Connection für Massen-Inserts vor und eröffnet explizit eine
+    Transaktion, die mit c.commit() abgeschlossen wird.
+    :param c: offene Connection
+    """
+    for pragma in BULK_PRAGMAS:
+        c.cur.execute(pragma)  # journal_mode geht nicht innerhalb einer Transaktion
+    c.cur.execute("BEGIN")
+
+
+# größere Batches bringen bei sqlite kaum noch etwas, kosten aber Speicher
+BATCH_SIZE = 10_000
+
+
+def chunked(rows: Iterable, n: int = BATCH_SIZE) -> Iterator[list]:
+    """
+    Zerlegt rows in Listen von höchstens n Elementen.
+    :param rows: beliebiges Iterable, auch ein Generator
+    :param n: maximale Größe eines Batches
+    :return: Generator über die Batches
+    """
+    it = iter(rows)
+    while True:
+        batch = list(islice(it, n))
+        if not batch:
+            return
+        yield batch
+
+
+# Die Statements werden einmal als Konstanten gehalten: sqlite3 cached übersetzte
+# Statements pro Connection anhand des SQL-Textes.
+
+# https://database.guide/how-on-conflict-works-in-sqlite/
+UPSERT_STATIONEN = """
+    INSERT OR REPLACE INTO stationen
+    VALUES (?,?,?,?,?,?,?,?)
+"""
+
+INSERT_READINGS = """
+    INSERT OR IGNORE INTO readings
+    VALUES (?, ?,?,?,?,?, ?, ?,?)
+"""
+
+# mehrere Zeilen pro Statement sparen das Binden und Ausführen je Zeile;
+# 100 x 9 Parameter bleiben unter dem alten Limit SQLITE_MAX_VARIABLE_NUMBER=999
+ROWS_PER_INSERT = 100
+INSERT_READINGS_MULTI = """
+    INSERT OR IGNORE INTO readings
+    VALUES """ + ",".join(["(?,?,?,?,?,?,?,?,?)"] * ROWS_PER_INSERT)
+
+# wie in schema/hr-temp-00.sql
+CREATE_INDEX_YMDH = """
+    CREATE UNIQUE INDEX IF NOT EXISTS readings_ymdh
+    ON readings (station, year, month, day, hour)
+"""
+
+# cf. https://stackoverflow.com/a/4330694/3991164
+UPSERT_RECENT = """
+    INSERT OR REPLACE
+    INTO recent (station, yyyymmddhh)
+    VALUES (?, ?)
+"""
+
+UPSERT_FILE_MDTM = """
+    INSERT OR REPLACE
+    INTO file_mdtm (fnam, mdtm)
+    VALUES (?, ?)
+"""
 
 
 class ProcessStationen:
@@ -60,47 +146,59 @@ class ProcessStationen:
         with johanna.Timer() as t:
             ftp = ftplight.dwd("climate_environment/CDC/observations_germany/climate/hourly/air_temperature/historical")
             fnam = "TU_Stundenwerte_Beschreibung_Stationen.txt"
-            self.lines = ftplight.ftp_retrlines(ftp, from_fnam=fnam, verbose=True)
-            self.rows = []
-            self.cnt = 0
-            for line in self.lines:
-                if line.startswith("Stations_id") or line.startswith("-----------"):
-                    pass
-                else:
-                    """
-                    Format:
-                             1         2         3         4         5         6         7         8         9        10
-                    ....,....|....,....|....,....|....,....|....,....|....,....|....,....|....,....|....,....|....,....|....,....|....,....|....,....|
-                    04692 20080301 20181130            229     50.8534    7.9966 Siegen (Kläranlage)                      Nordrhein-Westfalen
-                    """
-                    parts = line.split()
-                    tup = (
-                        # Tabelle stationen
-                        int(parts[0]),  # station integer,
-                        iso_date(parts[1]),  # yymmdd_von text,
-                        iso_date(parts[2]),  # yymmdd_bis text,
-                        int(parts[3]),  # hoehe integer,
-                        float(parts[4]),  # breite real,
-                        float(parts[5]),  # laenge real,
-                        " ".join(parts[6:-1]),  # name text,
-                        parts[-1]  # (bundes)land text
-                    )
-                    self.rows.append(tup)
-                    self.cnt += 1
-            logging.info(f"{self.cnt} Stationen gelesen und geparst {t.read()}")
+            # binär am Stück holen statt zeilenweise per Callback, geparst wird später in einem Rutsch
+            content = ftplight.ftp_retrbinary(ftp, from_fnam=fnam)
+            try:
+                text = content.decode("utf-8")
+            except UnicodeDecodeError:
+                # die Datendateien des DWD sind latin-1, die Stationsliste war es auch mal
+                text = content.decode("latin-1")
+            self.lines = text.splitlines()
+            logging.info(f"{len(self.lines)} Zeilen gelesen {t.read()}")
             ftp.quit()  # TODO quit() or close()
         logging.info(f"Verbindung zum DWD geschlossen {t.read()}")
 
+    def _parse(self):
+        """
+        Generator über die geparsten Stationen, damit executemany die Zeilen
+        direkt abholen kann, ohne dass sie vorher in einer Liste landen.
+        :return: Tupel, die in die Tabelle stationen eingefügt werden können
+        """
+        self.cnt = 0
+        for line in self.lines:
+            if line.startswith("Stations_id") or line.startswith("-----------"):
+                continue
+            """
+            Format (feste Spaltenbreiten):
+                     1         2         3         4         5         6         7         8         9        10
+            ....,....|....,....|....,....|....,....|....,....|....,....|....,....|....,....|....,....|....,....|....,....|....,....|....,....|
+            04692 20080301 20181130            229     50.8534    7.9966 Siegen (Kläranlage)                      Nordrhein-Westfalen
+            """
+            self.cnt += 1
+            yield (
+                # Tabelle stationen
+                int(line[0:5]),  # station integer,
+                iso_date(line[6:14]),  # yymmdd_von text,
+                iso_date(line[15:23]),  # yymmdd_bis text,
+                int(line[23:38]),  # hoehe integer,
+                float(line[38:50]),  # breite real,
+                float(line[50:60]),  # laenge real,
+                line[61:102].strip(),  # name text,
+                line[102:].strip()  # (bundes)land text
+            )
+
     def _upsert(self):
         with johanna.Timer() as t:
             with johanna.Connection("insert stationen") as c:
-                # https://database.guide/how-on-conflict-works-in-sqlite/
-                c.cur.executemany("""
-                    INSERT OR REPLACE INTO stationen
-                    VALUES (?,?,?,?,?,?,?,?)
-                """, self.rows)
-                c.commit()
-        logging.info(f"{self.cnt} Stationen in die Datenbank geschrieben {t.read()}")
+                # unveränderte Stationen nicht neu schreiben (REPLACE ist delete + insert)
+                known = set(c.cur.execute("SELECT * FROM stationen"))
+                changed = [row for row in self._parse() if row not in known]
+                if changed:
+                    begin_bulk(c)
+                    c.cur.executemany(UPSERT_STATIONEN, changed)
+                    c.commit()
+        logging.info(f"{self.cnt} Stationen geparst, {len(changed)} davon neu oder geändert "
+                     f"in die Datenbank geschrieben {t.read()}")
 
 
 # https://www.giga.de/ratgeber/specials/abkuerzungen-der-bundeslaender-in-deutschland-tabelle/
@@ -114,7 +212,7 @@ LAND_MAP = {
     "Hessen": "HE",
     "Mecklenburg-Vorpommern": "MV",
     "Niedersachsen": "NI",
-    "Nordrhein-Westfalen": "",
+    "Nordrhein-Westfalen": "NW",
     "Rheinland-Pfalz": "RP",
     "Saarland": "SL",
     "Sachsen": "SN",
@@ -124,6 +222,16 @@ LAND_MAP = {
     "?": "?"
 }
 
+# readings wird hier nicht gelesen, recent ist der Stand; geprüft wird das mit --check
+SELECT_STATION = """
+    SELECT
+        s.station, name, land, yyyymmdd_von, yyyymmdd_bis,
+        ifnull(rc.yyyymmddhh, '1700010100')
+    FROM stationen s
+    LEFT OUTER JOIN recent rc ON s.station = rc.station
+"""
+
+
 @dataclass
 class Station:
     station: int
@@ -132,42 +240,44 @@ class Station:
     isodate_von: str
     isodate_bis: str
     dwdts_recent: str       # last known as in recent table
-    dwdts_readings: str     # last known as in readings table
     description: str
     populated: bool = False
 
-    def __init__(self, station):
-        # select < 0.6 millis :)
-        SQL = """select 
-                name, land, yyyymmdd_von, yyyymmdd_bis, 
-                ifnull(rc.yyyymmddhh, '1700010100'),
-                ifnull(max(rd.dwdts), '1700010100') 
-            from stationen s
-            left outer join recent rc on s.station = rc.station
-            left join readings rd on s.station = rd.station
-            where s.station = ?"""
-
+    def __init__(self, station: int, row: tuple = None):
+        """
+        :param station: Stationsnummer
+        :param row: Zeile aus SELECT_STATION, wenn schon gelesen; sonst wird die Station abgefragt
+        """
         self.station = station
-        with johanna.Timer() as t:
+        if row is None:
             with johanna.Connection(f"Station.__init__({station})") as c:
-                with johanna.Timer() as t:
-                    c.cur.execute(SQL, (station,))
-                    row = c.cur.fetchone()
-                    if row:
-                        self.name = row[0]
-                        self.land = row[1]
-                        self.isodate_von = row[2]
-                        self.isodate_bis = row[3]
-                        self.dwdts_recent = row[4]  # aus Tabelle
-                        self.dwdts_readings = row[5]  # aus Daten
-                        assert self.dwdts_recent == self.dwdts_readings, \
-                            f"recent: {self.dwdts_recent} vs. Daten: {self.dwdts_readings}"
-                        self.populated = True
-                        self.description = f"{self.station}, {self.name} ({LAND_MAP[self.land]})"
-                        logging.info(f"{self.description}: {self.isodate_von}..{self.isodate_bis} "
-                                     f"rc={self.dwdts_recent} rd={self.dwdts_readings}")
-                    else:
-                        self.populated = False
+                # select < 0.6 millis :)
+                c.cur.execute(SELECT_STATION + " WHERE s.station = ?", (station,))
+                row = c.cur.fetchone()
+        if row:
+            self.name = row[1]
+            self.land = row[2]
+            self.isodate_von = row[3]
+            self.isodate_bis = row[4]
+            self.dwdts_recent = row[5]  # aus Tabelle
+            self.populated = True
+            self.description = f"{self.station}, {self.name} ({LAND_MAP.get(self.land, '?')})"
+        else:
+            self.populated = False
+
+
+def load_stations() -> Dict[int, Station]:
+    """
+    Alle Stationen mit einer einzigen Abfrage, statt einer Connection und einem
+    SELECT pro File.
+    :return: dict Stationsnummer -> Station
+    """
+    with johanna.Timer() as t:
+        with johanna.Connection("load_stations") as c:
+            rows = c.cur.execute(SELECT_STATION).fetchall()
+        stations = {row[0]: Station(row[0], row) for row in rows}
+    logging.info(f"{len(stations)} Stationen gelesen {t.read()}")
+    return stations
 
 
 def parse_clist(s: str) -> List[int]:
@@ -201,178 +311,245 @@ def is_data_expected(fnam: str = None, s: Station = None) -> bool:
     assert s.populated
     if fnam.endswith("_hist.zip"):
         bis = fnam.split(".")[0].split("_")[4] + "23"
-        if s.dwdts_readings > "1701" and bis < "2018":
+        if s.dwdts_recent > "1701" and bis < "2018":
             # es gibt bereits Werte und die Station sendet schon länger nicht mehr
             return False
-        return s.dwdts_readings < bis
+        return s.dwdts_recent < bis
     else:
         assert fnam.endswith("_akt.zip"), fnam
         # we do not have to care for time zone here, b/c DWD will typically upload yesterdays data between 9am and 10am local time
         yester_dwdts = (date.today() + timedelta(days=-1)).strftime("%Y%m%d") + "23"
         # Vereinfachung: Wenn Daten bis gestern schon da sind -> nix tun
-        # TODO Wenn Daten bis zum Ende der Station schon da sind -> nix tun
-        return s.dwdts_readings < yester_dwdts
+        # DONE Wenn Daten bis zum Ende der Station schon da sind -> nix tun, sofern das File
+        # seit dem letzten Einlesen unverändert ist, s. drop_unchanged()
+        return s.dwdts_recent < yester_dwdts
 
 
 def station_from_fnam(fnam: str) -> int:
     return int(fnam.split(".")[0].split("_")[2])
 
 
+def reading_from_row(row: List[str]) -> tuple:
+    """
+    Wandelt eine Zeile aus produkt_*.txt in ein Tupel für die Tabelle readings.
+    Steht auf Modulebene, damit sie direkt per map() über den csv.reader laufen kann.
+    :param row: STATIONS_ID;MESS_DATUM;QN_9;TT_TU;RF_TU;eor
+    :return: Tupel passend zu INSERT_READINGS
+    """
+    ts = int(row[1])  # yyyymmddhh, einmal parsen und rechnen ist schneller als 4 Slices
+    return (
+        int(row[0]),  # station
+        row[1],
+        ts // 1000000, ts // 10000 % 100, ts // 100 % 100, ts % 100,  # year, month, day, hour
+        int(row[2]),  # q
+        None if row[3].strip() == "-999" else float(row[3]),  # temp
+        None if row[4].strip() == "-999" else float(row[4])  # humid
+    )
+
+
 NULLDATUM = "1700010100"      # Früher als alles. 1970 geht ja beim DWD nicht :)
 
 class ProcessDataFile:
-    # Downloads, parses and saves a CDC data file from an open FTP connection
+    # Parses and saves a downloaded CDC data file
 
-    def __init__(self, ftp: FTP, fnam: str, verbose: bool = False):
+    def __init__(self, fnam: str, content: bytes, station: Station, recent: dict, c: johanna.Connection):
         """
-        :param ftp: geöffnete FTP Verbindung mit dem richtigen Arbeitsverzeichnis
-        :param fnam: Name des herunterzuladenden Files
-        :param verbose: Konsolenausgabe als Fortschrittinfo -- DO NOT USE IN PRODUCTION
+        :param fnam: Name des heruntergeladenen Files
+        :param content: Inhalt des heruntergeladenen zip-Files, None wenn der Download gescheitert ist
+        :param station: die Station zum File, wie in process_dataset bereits ermittelt
+        :param recent: Inhalt der Tabelle recent als dict station -> yyyymmddhh, wird hier nachgeführt
+        :param c: offene Connection mit laufender Transaktion, die für alle Files eines Laufs benutzt wird
         """
-        self._verbose = verbose
-        self.did_download = False
-        logging.info(f'DataFile(_,"{fnam}")')
-
-        station_nr = int(fnam.split(".")[0].split("_")[2])  # geht erfreulicherweise für hist und akt
-        self.station = Station(station_nr)
-        logging.info(f"Station {self.station.description} (Daten bis {self.station.dwdts_recent} bereits vorhanden)")
-        if is_data_expected(fnam, self.station):
-            with johanna.Timer() as t:
-                with TemporaryDirectory() as temp_dir:
-                    temp_dir = Path(temp_dir)
-                    logging.info(f"Temporäres Verzeichnis: {temp_dir}")
-                    zipfile_path = ftplight.ftp_retrbinary(ftp, from_fnam=fnam, to_path=temp_dir/fnam, verbose=True)
-                    if not zipfile_path:
-                        johanna.flag_as_error()
-                        logging.error(f"Kann die Daten der Station {self.station.description} nicht herunterladen.")
-                        return
-                    produkt_path = self._extract(zipfile_path, temp_dir)
-                    readings = self._parse(produkt_path)
-                    if readings:
-                        # TODO connection mit retry absichern
-                        with johanna.Connection("insert readings") as c:
-                            self._insert_readings(readings, c)
-                            last_date = self._update_recent(readings, c)
-                            c.commit()  # gemeinsamer commit ist sinnvoll
-                        logging.info(f"Werte für Station {self.station.description} bis {last_date} verarbeitet {t.read()}")
-                    else:
-                        logging.info(f"Keine Werte für Station {self.station.description} nach {self.station.dwdts_recent} gefunden {t.read()}")
-            if temp_dir.exists():
-                johanna.flag_as_error()
-                logging.error(f"Temporäres Verzeichnis {temp_dir} wurde NICHT entfernt")
-        else:
-            logging.info(f"File {fnam} wird nicht heruntergeladen, da keine neuen Daten zu erwarten sind.")
+        logging.info(f'DataFile("{fnam}")')
 
-    def _extract(self, zipfile_path: Path, target_path: Path) -> Path:
+        station_nr = station_from_fnam(fnam)  # geht erfreulicherweise für hist und akt
+        assert station.station == station_nr, f"Station aus Filename: {station_nr}, aus Objekt: {station.station}"
+        self.station = station
+        self.dwdts_recent = recent.get(station_nr, NULLDATUM)
+        logging.info(f"Station {self.station.description}: {self.station.isodate_von}..{self.station.isodate_bis} "
+                     f"(Daten bis {self.dwdts_recent} bereits vorhanden)")
+        if not content:
+            johanna.flag_as_error()
+            logging.error(f"Kann die Daten der Station {self.station.description} nicht herunterladen.")
+            return
+        with johanna.Timer() as t:
+            # der Generator aus _parse wird direkt von executemany abgeholt
+            last_date = self._insert_readings(self._parse(BytesIO(content)), c)
+            # c.commit() -- commit außerhalb, für mehrere Files gemeinsam
+            if last_date:
+                recent[station_nr] = last_date  # falls es noch ein File für die Station gibt
+                logging.info(f"Werte für Station {self.station.description} bis {last_date} verarbeitet {t.read()}")
+            else:
+                logging.info(f"Keine Werte für Station {self.station.description} nach {self.dwdts_recent} gefunden {t.read()}")
+
+    def _find_produkt(self, zipfile: ZipFile) -> ZipInfo:
         """
         Die zip-Files enthalten jeweils eine Reihe von html und txt Dateien,
         die die Station und ihre Messgeräte beschreiben. Für den Zweck dieser
         Auswertungen hier sind das urban legends, die getrost ignoriert werden
         können. Die Nutzdaten befinden sich in einem CSV File produkt_*.txt.
-        Dieses wird ins tmp/-Verzeichnis extrahiert.
+        Dieses wird direkt aus dem zip-File gelesen, nicht extrahiert.
 
-        :param zipfile_path: Path der zu entpackenden zip-Files
-        :param target_path: Path des Zielverzeichnisses zum entpacken
-        :return: Path des Datenfiles
+        :param zipfile: geöffnetes zip-File
+        :return: ZipInfo des Datenfiles
         """
-        zipfile = ZipFile(zipfile_path)
         for zi in zipfile.infolist():
             if zi.filename.startswith("produkt_"):
-                produkt = zipfile.extract(zi, path=str(target_path))
-                logging.info(f"Daten in {produkt}")
-                return Path(produkt)
-        raise ValueError(f"Kein produkt_-File in {zipfile_path}")
+                logging.info(f"Daten in {zi.filename}")
+                return zi
+        raise ValueError(f"Kein produkt_-File in {zipfile.filename}")
 
     # TODO prüfen, dass alle Werte auch von der gewünschten Station kommen
-    def _parse(self, produkt_path: Path) -> list:
+    def _parse(self, zip_file: BinaryIO) -> Iterator[tuple]:
         """
-        Parsen des Datenfiles. Für die Feststellung zu unterdrückender Zeilen wird self.station benutzt
-        :param produkt_path: Pfad des Datenfiles
-        :return: eine Liste von Tupeln, die in die Tabelle readings eingefügt werden können
+        Parsen des Datenfiles, direkt aus dem zip-File heraus. Für die Feststellung
+        zu unterdrückender Zeilen wird self.station benutzt
+        :param zip_file: das zip-File als file-like object
+        :return: Generator über Tupel, die in die Tabelle readings eingefügt werden können
         """
 
-        def ymdh(yymmddhh: str) -> tuple:
-            """
-            Aufbrechen der DWD Zeitangabe in numerische Zeiteinheiten.
-            :param yymmddhh: Stunde in DWD-Format
-            :return: Tuple mit den numerischen Teilkomponenten
-            """
-            y = int(yymmddhh[:4])
-            m = int(yymmddhh[4:6])
-            d = int(yymmddhh[6:8])
-            h = int(yymmddhh[-2:])
-            return y, m, d, h
-
-        with johanna.Timer() as t:
-            readings = list()
-            with open(produkt_path, newline='') as csvfile:
-                spamreader = csv.reader(csvfile, delimiter=';')
-                cnt = 0
-                shown = 0
-                skipped = -1
-                for row in spamreader:
-                    cnt += 1
-                    if cnt == 1:                    # skip header line
-                        continue
-                    # surpress data that might be in DB already
-                    if row[1] <= self.station.dwdts_recent:
-                        continue
-                    elif skipped == -1:  # now uncond.
-                        skipped = cnt - 2  # current and first excluded
-                        logging.info(f"{skipped} Messwerte vor dem {self.station.dwdts_recent} wurden übersprungen")
-                    if shown <= 1:  # show first 2 rows taken
-                        shown += 1
-                        logging.info(f"{row[0]}, {row[1]}")
-                    y, m, d, h = ymdh(row[1])
-                    tup = (
-                        int(row[0]),  # station
-                        row[1],
-                        y, m, d, h,  # row[1],
-                        int(row[2]),  # q
-                        None if row[3].strip() == "-999" else float(row[3]),  # temp
-                        None if row[4].strip() == "-999" else float(row[4])  # humid
-                    )
-                    readings.append(tup)
-        logging.info(f"{len(readings)} neue Messwerte für Station {self.station.description} gefunden {t.read()}")
-        return readings
-
-    def _insert_readings(self, readings: list, c: johanna.Connection) -> None:
-        with johanna.Timer() as t:
-            c.cur.executemany("""
-                INSERT OR IGNORE INTO readings
-                VALUES (?, ?,?,?,?,?, ?, ?,?)
-            """, readings)
-            # c.commit() -- commit außerhalb
-        logging.info(f"{len(readings)} Zeilen in die Datenbank eingearbeitet {t.read()}")
-        johanna.collect_stat("db_readings_inserted", len(readings))
-
-    def _update_recent(self, readings: list, c: johanna.Connection) -> str:
-        # get station, assuming that is the same in all tuples
-        station = readings[0][0]
-        # get max time of reading from last line
-        # alternatively: https://stackoverflow.com/a/4800441/3991164
-        yyyymmddhh = readings[-1][1]
+        dwdts_recent = self.dwdts_recent  # lokale Namen sind in der Schleife schneller
+        with ZipFile(zip_file) as zipfile, \
+                zipfile.open(self._find_produkt(zipfile)) as produkt, \
+                TextIOWrapper(produkt, encoding="latin-1", newline='') as csvfile:
+            spamreader = csv.reader(csvfile, delimiter=';')
+            next(spamreader, None)  # skip header line
+            # surpress data that might be in DB already -- die Zeilen sind zeitlich sortiert,
+            # ab der ersten neuen Zeile muss also nicht mehr verglichen werden
+            skipped = 0
+            for row in spamreader:
+                if row[1] > dwdts_recent:
+                    break
+                skipped += 1
+            else:
+                logging.info(f"Alle {skipped} Messwerte liegen vor dem {dwdts_recent}")
+                return
+            logging.info(f"{skipped} Messwerte vor dem {dwdts_recent} wurden übersprungen")
+            logging.info(f"{row[0]}, {row[1]}")  # erste übernommene Zeile
+            yield from map(reading_from_row, chain((row,), spamreader))
+
+    def _insert_readings(self, readings: Iterable[tuple], c: johanna.Connection) -> str:
+        """
+        Fügt die Messwerte ein und vermerkt den neuesten in der Tabelle recent.
+        :param readings: Tupel für die Tabelle readings
+        :param c: offene Connection mit laufender Transaktion
+        :return: yyyymmddhh des neuesten Messwertes, None wenn es keine gab
+        """
+        cnt = 0
+        newest = None
+        by_dwdts = itemgetter(1)
         with johanna.Timer() as t:
-            # cf. https://stackoverflow.com/a/4330694/3991164
-            c.cur.execute("""
-                INSERT OR REPLACE
-                INTO recent (station, yyyymmddhh)
-                VALUES (?, ?)
-            """, (station, yyyymmddhh))
+            for batch in chunked(readings):
+                full = len(batch) - len(batch) % ROWS_PER_INSERT
+                c.cur.executemany(INSERT_READINGS_MULTI, (
+                    list(chain.from_iterable(batch[i:i + ROWS_PER_INSERT]))
+                    for i in range(0, full, ROWS_PER_INSERT)))
+                c.cur.executemany(INSERT_READINGS, batch[full:])
+                cnt += len(batch)
+                # nicht auf die Reihenfolge im File verlassen, max() läuft in C
+                candidate = max(batch, key=by_dwdts)
+                if newest is None or candidate[1] > newest[1]:
+                    newest = candidate
+            if newest:
+                # dwdts ist fest 10-stellig, also auch als Text richtig sortiert
+                # alternatively: https://stackoverflow.com/a/4800441/3991164
+                c.cur.execute(UPSERT_RECENT, newest[:2])
             # c.commit() -- commit außerhalb
-        logging.info(f"Neuester Messwert {yyyymmddhh} in der Datenbank vermerkt {t.read()}")
-        return yyyymmddhh
+        logging.info(f"{cnt} neue Messwerte für Station {self.station.description} in die Datenbank eingearbeitet {t.read()}")
+        johanna.collect_stat("db_readings_inserted", cnt)
+        return newest[1] if newest else None
+
 
+# ein commit pro File kostet jedesmal einen fsync, alles in einer Transaktion
+# würde bei einem Abbruch zu viel Arbeit verwerfen
+FILES_PER_COMMIT = 20
 
 # Germany > hourly > Temperaure > hictorical
 SERVER = "opendata.dwd.de"
 REMOTE_BASE = "climate_environment/CDC/observations_germany/climate/hourly/air_temperature"
 
+# die Verzeichnisse ändern sich höchstens einmal am Tag; deutlich kürzer als der
+# tägliche Lauf, damit nicht die Uhrzeit des cron-Jobs über das NLST entscheidet
+FILE_LIST_TTL_SEC = 12 * 3600
+
+
+def get_file_list(kind: str) -> List[str]:
+    """
+    Liefert die zip-Files eines Verzeichnisses beim DWD. Das Ergebnis des NLST
+    wird in der Tabelle file_list zwischengespeichert und für FILE_LIST_TTL_SEC
+    wiederverwendet, es sei denn, process_dataset hat die Liste nach einem
+    gescheiterten Download verworfen.
+    :param kind: recent oder historical
+    :return: Liste der Dateinamen
+    """
+    now = int(time.time())
+    with johanna.Connection(f"file_list {kind}") as c:
+        cached = c.cur.execute("""
+            SELECT fnam FROM file_list
+            WHERE kind = ? AND seen_ts > ?
+            ORDER BY fnam
+        """, (kind, now - FILE_LIST_TTL_SEC)).fetchall()
+    if cached:
+        logging.info(f"{len(cached)} Files aus der zwischengespeicherten Liste für {kind}")
+        return [fnam for fnam, in cached]
+
+    ftp = ftplight.dwd(REMOTE_BASE + "/" + kind)
+    file_list = ftplight.ftp_nlst(ftp)
+    ftp.close()  # für die Downloads gibt es eigene Verbindungen
+    logging.info(f"Connection zum DWD geschlossen")
+    if file_list:
+        with johanna.Connection(f"file_list {kind}") as c:
+            c.cur.execute("DELETE FROM file_list WHERE kind = ?", (kind,))
+            c.cur.executemany("INSERT INTO file_list VALUES (?, ?, ?)",
+                              [(kind, fnam, now) for fnam in file_list])
+            c.commit()
+    return file_list
+
+
+# Puffer, falls die Stationsliste beim DWD ein paar Tage hinterherhinkt
+STOPPED_DAYS = 7
+
+
+def drop_unchanged(remote: str, fnams: List[str], stations: Dict[int, Station]) -> Tuple[List[str], Dict[str, str]]:
+    """
+    Für Stationen, die laut Stationsliste seit STOPPED_DAYS Tagen nicht mehr senden,
+    wird das _akt.zip nur heruntergeladen, wenn sich sein MDTM seit dem letzten
+    Einlesen geändert hat. Ein MDTM ist viel billiger als ein RETR. Die Stationsliste
+    wird vor jedem Lauf aufgefrischt (s. main), aktive Stationen werden also nicht
+    geprüft; die MDTM laufen seriell über eine einzige Verbindung.
+    :param remote: Verzeichnis beim DWD
+    :param fnams: Files, für die laut is_data_expected neue Daten zu erwarten sind
+    :param stations: Stationen, wie von load_stations geliefert
+    :return: fnams ohne die unveränderten Files, sowie dict fnam -> MDTM für die
+        geprüften Files, das nach dem erfolgreichen Einlesen in file_mdtm landet
+    """
+    stopped = (date.today() + timedelta(days=-STOPPED_DAYS)).isoformat()
+    suspects = [fnam for fnam in fnams
+                if fnam.endswith("_akt.zip") and stations[station_from_fnam(fnam)].isodate_bis < stopped]
+    if not suspects:
+        return fnams, {}
+    with johanna.Connection("file_mdtm") as c:
+        loaded = dict(c.cur.execute("SELECT fnam, mdtm FROM file_mdtm"))
+    unchanged = set()
+    mdtms = {}
+    ftp = ftplight.dwd(remote)
+    for fnam in suspects:
+        mdtm = ftplight.ftp_mdtm(ftp, fnam)
+        if not mdtm:
+            continue  # dann eben herunterladen
+        if mdtm == loaded.get(fnam):
+            logging.info(f"File {fnam} ist seit {mdtm} unverändert und wird nicht heruntergeladen.")
+            unchanged.add(fnam)
+        else:
+            mdtms[fnam] = mdtm
+    ftp.close()
+    return [fnam for fnam in fnams if fnam not in unchanged], mdtms
+
+
 def process_dataset(kind: str) -> None:
 
     remote = REMOTE_BASE + "/" + kind
-    ftp = ftplight.dwd(remote)
-    file_list = ftplight.ftp_nlst(ftp)
+    file_list = get_file_list(kind)
     if not file_list:
         raise Exception("Da kann ich nix machen.")
 
@@ -384,23 +561,113 @@ def process_dataset(kind: str) -> None:
         logging.info(f"Alle {len(file_list)} Stationen herunterladen.")
     # DONE use filter
 
-    for i, fnam in enumerate(file_list):
-        if station_filter:
-            station = station_from_fnam(fnam)
-            if not station in station_filter:
-                continue
-        johanna.sleep(2.0)  # pace down a little bit
-        p = ProcessDataFile(ftp, fnam, verbose=True)
-        logging.info(f"--- {i/len(file_list)*100:.0f} %")
+    # erst aussortieren, dann nur die Files mit neuen Daten parallel herunterladen
+    todo = []
+    stations = load_stations()  # ProcessDataFile benutzt die Objekte weiter
+    # sortiert liegen die _hist-Files einer Station zeitlich hintereinander; ProcessDataFile
+    # überspringt, was vor recent liegt, ein späteres File darf also nicht zuerst kommen
+    for fnam in sorted(file_list):
+        station = station_from_fnam(fnam)
+        if station_filter and not station in station_filter:
+            continue
+        if station not in stations:
+            stations[station] = Station(station)
+        if is_data_expected(fnam, stations[station]):
+            todo.append(fnam)
+        else:
+            logging.info(f"File {fnam} wird nicht heruntergeladen, da keine neuen Daten zu erwarten sind.")
+    todo, mdtms = drop_unchanged(remote, todo, stations)
+    logging.info(f"{len(todo)} von {len(file_list)} Files werden heruntergeladen")
+
+    # die zip-Files bleiben im Speicher, kein Umweg über temporäre Dateien
+    workers = int(johanna.get("hr-temp", "ftp-verbindungen", 4))
+    if not 0 < workers <= 8:  # mehr lässt parallel_download nicht zu
+        logging.warning(f"ftp-verbindungen = {workers} liegt nicht zwischen 1 und 8, wird begrenzt.")
+        workers = min(max(workers, 1), 8)
+    max_per_sec = float(johanna.get("hr-temp", "ftp-dateien-pro-sekunde", None) or 0)
+    if max_per_sec < 0:
+        logging.warning(f"ftp-dateien-pro-sekunde = {max_per_sec} ist negativ, Downloads werden nicht begrenzt.")
+    max_per_sec = max_per_sec if max_per_sec > 0 else None  # 0: keine Begrenzung
+    # eine Connection für alle Files, damit der Page Cache von sqlite erhalten bleibt
+    # TODO connection mit retry absichern
+    with johanna.Connection(f"process_dataset({kind})") as c:
+        # einmal lesen statt pro File, ProcessDataFile hält das dict aktuell
+        recent = dict(c.cur.execute("SELECT station, yyyymmddhh FROM recent"))
+        if kind == "historical":
+            # Beim Erstbefüllen den Sekundärindex erst am Ende in einem Rutsch aufbauen.
+            # Bricht der Lauf ab, legt ihn apply_schema beim nächsten Start wieder an.
+            c.cur.execute("DROP INDEX IF EXISTS readings_ymdh")
+        downloads = ftplight.parallel_download(remote, todo, workers=workers, max_per_sec=max_per_sec)
+        begin_bulk(c)
+        for i, (fnam, content) in enumerate(downloads):
+            # ein kaputtes File (BadZipFile, kein produkt_-File, ...) soll weder den Lauf
+            # abbrechen noch die übrigen Files seines Commits verwerfen
+            c.cur.execute("SAVEPOINT datafile")
+            try:
+                ProcessDataFile(fnam, content, stations[station_from_fnam(fnam)], recent, c)
+            except Exception:
+                c.cur.execute("ROLLBACK TO datafile")
+                johanna.flag_as_error()
+                logging.exception(f"File {fnam} kann nicht verarbeitet werden.")
+            else:
+                if not content:
+                    # vielleicht umbenannt: beim nächsten Lauf die Liste neu holen
+                    c.cur.execute("DELETE FROM file_list WHERE kind = ?", (kind,))
+                elif fnam in mdtms:
+                    # erst jetzt, damit ein gescheiterter Download beim nächsten Lauf nachgeholt wird
+                    c.cur.execute(UPSERT_FILE_MDTM, (fnam, mdtms[fnam]))
+            c.cur.execute("RELEASE datafile")
+            logging.info(f"--- {(i + 1) / len(todo) * 100:.0f} %")
+            if (i + 1) % FILES_PER_COMMIT == 0:
+                c.commit()
+                c.cur.execute("BEGIN")
+        c.commit()
+        with johanna.Timer() as t:
+            if kind == "historical":
+                c.cur.execute(CREATE_INDEX_YMDH)
+                logging.info(f"Index readings_ymdh aufgebaut {t.read()}")
+                c.cur.execute("ANALYZE")  # nach dem Erstbefüllen einmal vollständig
+            else:
+                # https://www.sqlite.org/lang_analyze.html#approx
+                c.cur.execute("PRAGMA analysis_limit=1000")
+                c.cur.execute("PRAGMA optimize")
+        logging.info(f"Statistiken für den Query Planner aktualisiert {t.read()}")
 
     hurz = 17  # für Brechpunkt
 
-    ftp.close()
-    logging.info(f"Connection zum DWD geschlossen")
-
     #logging.info("Statistik\n" + json.dumps(GLOBAL_STAT, indent=4))
 
 
+# beide Richtungen: Stationen mit Messwerten, aber falschem oder fehlendem recent,
+# und recent-Einträge für Stationen ganz ohne Messwerte
+CHECK_RECENT = """
+    SELECT rd.station, rc.yyyymmddhh, rd.dwdts
+    FROM (SELECT station, max(dwdts) AS dwdts FROM readings GROUP BY station) rd
+    LEFT OUTER JOIN recent rc ON rd.station = rc.station
+    WHERE rc.yyyymmddhh IS NULL OR rc.yyyymmddhh != rd.dwdts
+    UNION ALL
+    SELECT rc.station, rc.yyyymmddhh, NULL
+    FROM recent rc
+    WHERE NOT EXISTS (SELECT 1 FROM readings rd WHERE rd.station = rc.station)
+"""
+
+
+def check_recent() -> None:
+    """
+    Vergleicht die Tabelle recent mit dem tatsächlich neuesten Messwert je
+    Station. Das war früher ein assert bei jeder Station, braucht aber einen
+    Durchgang über den ganzen Index von readings und gehört nicht in jeden Lauf.
+    """
+    with johanna.Timer() as t:
+        with johanna.Connection("check_recent") as c:
+            mismatches = c.cur.execute(CHECK_RECENT).fetchall()
+    for station, recent, readings in mismatches:
+        logging.error(f"Station {station}: recent={recent} vs. readings={readings}")
+    if mismatches:
+        johanna.flag_as_error()
+    logging.info(f"{len(mismatches)} Abweichungen zwischen recent und readings gefunden {t.read()}")
+
+
 def experimental():
     pass
 
@@ -410,6 +677,7 @@ OPCODE = None     # enable one for interactive debugging in IDE w/o using run co
 # OPCODE = "recent"
 # OPCODE = "historical"
 # OPCODE = "stations"
+# OPCODE = "check"
 
 def main():
     # support interactive debugging
@@ -418,6 +686,7 @@ def main():
             "--recent": OPCODE == "recent",
             "--historical": OPCODE == "historical",
             "--stations": OPCODE == "stations",
+            "--check": OPCODE == "check",
             "--test": OPCODE == "test"
         }
         logging.info(f"interactive debugging, OPCODE={OPCODE}")
@@ -435,9 +704,17 @@ def main():
         process_dataset("historical")
 
     if args["--recent"]:
+        try:
+            ProcessStationen()  # drop_unchanged braucht aktuelle Enddaten der Stationen
+        except Exception:
+            # mit der gespeicherten Liste kostet das höchstens ein paar MDTM zu viel
+            logging.exception("Stationsliste nicht aufgefrischt, es geht mit der gespeicherten weiter.")
         process_dataset("recent")
         # TODO nach dem Runterladen eine Kopie der Datenbank für Auswertungszwecke machen
 
+    if args["--check"]:
+        check_recent()
+
     if args["--test"]:
         experimental()
 
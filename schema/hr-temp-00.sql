@@ -40,3 +40,17 @@ CREATE TABLE IF NOT EXISTS stationen (
     name TEXT,
     land TEXT
 );
+
+-- Zwischenspeicher für das NLST der Verzeichnisse recent und historical
+CREATE TABLE IF NOT EXISTS file_list (
+    kind TEXT,            -- recent | historical
+    fnam TEXT,
+    seen_ts INTEGER,      -- Unix-Zeit des NLST
+    PRIMARY KEY (kind, fnam)
+);
+
+-- MDTM der _akt.zip-Files beim letzten erfolgreichen Einlesen, s. drop_unchanged()
+CREATE TABLE IF NOT EXISTS file_mdtm (
+    fnam TEXT PRIMARY KEY,
+    mdtm TEXT             -- YYYYMMDDHHMMSS in UTC, wie vom Server geliefert
+);
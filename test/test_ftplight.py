@@ -8,6 +8,8 @@ Created: 06.09.20
 """
 
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from ftplib import FTP
 from pathlib import Path
 
@@ -32,6 +34,17 @@ def main_repeat():
     ftplight.repeat(cb)
 
 
+def check_rate_limit():
+    # offline: 3 threads, 9 events, 20 per second -> at least 8 intervals of 50 ms
+    limit = ftplight.RateLimit(20.0)
+    t0 = time.monotonic()
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        stamps = sorted(executor.map(lambda _: (limit.wait(), time.monotonic())[1], range(9)))
+    assert stamps[-1] - t0 >= 0.4 - 0.01, stamps[-1] - t0
+    assert all(b - a >= 0.05 - 0.01 for a, b in zip(stamps, stamps[1:])), stamps
+    logging.info(f"RateLimit ok, {stamps[-1] - t0:.2f} s for 9 events")
+
+
 # Germany > hourly > Temperaure > hictorical
 REMOTE_BASE = "climate_environment/CDC/observations_germany/climate/hourly/air_temperature"
 LOCAL = Path("../local")
@@ -82,7 +95,22 @@ def get_potsdam():
     target = ftplight.ftp_retrbinary(ftp, fnam, LOCAL/fnam, verbose=True)
 
 
+def get_parallel():
+    remote = REMOTE_BASE + "/" + "recent"
+    ftp = ftplight.dwd(remote)
+    fnams = ftplight.ftp_nlst(ftp)[:12]
+    ftp.close()
+    logging.info("-"*80)
+    with johanna.Timer() as t:
+        for fnam, content in ftplight.parallel_download(remote, fnams, workers=4):
+            assert isinstance(content, bytes), type(content)
+            logging.info(f"{fnam}: {len(content):,} bytes")
+    logging.info(f"{len(fnams)} files {t.read()}")
+
+
 if __name__ == "__main__":
     johanna.main(None)
+    check_rate_limit()
     get_stationen()
     get_potsdam()
+    get_parallel()
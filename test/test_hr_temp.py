@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Test the parts of hr-temp.py that work without the DWD server.
+
+Created: 15.10.26
+"""
+
+import importlib.util
+import logging
+import sys
+import tempfile
+from pathlib import Path
+
+import johanna
+
+# hr-temp.py ist wegen des Bindestrichs nicht per import erreichbar
+HERE = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(HERE))  # für import ftplight in hr-temp.py
+spec = importlib.util.spec_from_file_location("hr_temp", HERE / "hr-temp.py")
+hr_temp = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(hr_temp)
+
+
+class FakeDataFile:
+    # genug von ProcessDataFile für _insert_readings
+    station = hr_temp.Station.__new__(hr_temp.Station)
+    station.description = "99999, Teststation (?)"
+
+
+def synthetic_readings(n: int) -> list:
+    return [
+        hr_temp.reading_from_row(["99999", f"{2000010100 + 100 * (i // 24) + i % 24}", "3", "1.5", "-999"])
+        for i in range(n)
+    ]
+
+
+def check_insert_readings():
+    # Grenzfälle der 100er-Gruppen und des Rests, auch über BATCH_SIZE hinaus
+    for n in [0, 1, 99, 100, 101, 10_001]:
+        readings = synthetic_readings(n)
+        with johanna.Connection("check_insert_readings") as c:
+            c.cur.execute("DELETE FROM readings")
+            c.cur.execute("DELETE FROM recent")
+            newest = hr_temp.ProcessDataFile._insert_readings(FakeDataFile(), readings, c)
+            c.commit()
+            cnt, = c.cur.execute("SELECT count(*) FROM readings").fetchone()
+            recent = c.cur.execute("SELECT yyyymmddhh FROM recent").fetchall()
+        assert cnt == n, f"{n} eingefügt, {cnt} in readings"
+        if n:
+            assert newest == max(r[1] for r in readings), newest
+            assert recent == [(newest,)], recent
+        else:
+            assert newest is None and not recent, (newest, recent)
+        logging.info(f"_insert_readings({n}) ok")
+
+
+def check_parse_stationen():
+    ps = hr_temp.ProcessStationen.__new__(hr_temp.ProcessStationen)
+    ps.lines = [
+        "Stations_id von_datum bis_datum Stationshoehe geoBreite geoLaenge Stationsname Bundesland",
+        "----------- --------- --------- ------------- --------- --------- ----------------------------------------- ----------",
+        "04692 20080301 20181130            229     50.8534    7.9966 Siegen (Kläranlage)                      Nordrhein-Westfalen",
+        "00722 19580101 20201014           1134     51.7986   10.6183 Brocken                                  Sachsen-Anhalt     ",
+    ]
+    rows = list(ps._parse())
+    assert rows == [
+        (4692, "2008-03-01", "2018-11-30", 229, 50.8534, 7.9966, "Siegen (Kläranlage)", "Nordrhein-Westfalen"),
+        (722, "1958-01-01", "2020-10-14", 1134, 51.7986, 10.6183, "Brocken", "Sachsen-Anhalt"),
+    ], rows
+    assert ps.cnt == 2
+    logging.info("ProcessStationen._parse ok")
+
+
+def check_reading_from_row():
+    row = ["   3987", "2020123123", "    3", "  -2.5", "-999", "eor"]
+    assert hr_temp.reading_from_row(row) == (3987, "2020123123", 2020, 12, 31, 23, 3, -2.5, None)
+    row = ["   3987", "2021010100", "    3", "-999", "  95.0", "eor"]
+    assert hr_temp.reading_from_row(row) == (3987, "2021010100", 2021, 1, 1, 0, 3, None, 95.0)
+    logging.info("reading_from_row ok")
+
+
+if __name__ == "__main__":
+    johanna.main(None, dotfolder=tempfile.mkdtemp(), dbname="hr-temp.sqlite")
+    johanna.apply_schema(HERE / "schema" / "hr-temp-00.sql")
+    check_reading_from_row()
+    check_parse_stationen()
+    check_insert_readings()